@@ -1,17 +1,18 @@
 """pandoc-source-exec is a panflute pandoc filter to execute source code and
 add the output to the pandoc document."""
 
+import concurrent.futures
+import functools
 import glob
+import itertools
 import os
 import re
+import shlex
 import subprocess
+import sys
 
 __version__ = '0.2.2'
 
-try:
-    from pexpect import replwrap
-except ImportError:
-    pass
 try:
     import panflute as pf
 except ImportError:
@@ -28,6 +29,82 @@ EXECUTORS = {
     'ruby': '/usr/bin/env ruby -e',
 }
 
+# The EXECUTORS split into argument tuples.
+EXECUTOR_ARGS = {k: tuple(shlex.split(v)) for k, v in EXECUTORS.items()}
+
+# The last comment line matplotlib2tikz writes before the tikzpicture.
+TIKZ_COMMENT = re.compile('% .* matplotlib2tikz v.*')
+
+# Lines with import statements, including their line break.
+IMPORT_STATEMENT = re.compile(r'^[ \t]*(?:import |from )[^\n]*\n?',
+                              re.MULTILINE)
+
+# The environment for executed code. Plots are only converted to tikz code, so
+# matplotlib does not need an interactive backend.
+EXECUTION_ENVIRONMENT = dict(os.environ, MPLBACKEND='Agg')
+
+# Separates the texts which are converted together in `to_latex`.
+LATEX_SEPARATOR = 'PANDOCSOURCEEXECSEPARATOR'
+
+# Executors which are served by a persistent worker process instead of
+# starting a new interpreter for each code block.
+WORKER_EXECUTORS = {EXECUTOR_ARGS['python'], EXECUTOR_ARGS['python3']}
+
+# The worker reads requests of the form b'MODE LENGTH\nCODE' from stdin,
+# compiles the code in the given mode ('exec' or 'single', as in the
+# interactive shell), executes it in a fresh __main__ module and replies with
+# b'LENGTH\nOUTPUT'. Imported modules are shared between requests, only open
+# pyplot figures are closed before each request. The protocol runs on
+# duplicates of the original stdin and stdout. While code runs, file
+# descriptors 1 and 2 point to a temporary file, so output of child processes
+# and C extensions is captured just like with a new process. Between requests
+# they point to stderr.
+WORKER_BOOTSTRAP = r'''
+import os, sys, tempfile, traceback, types
+main = sys.modules['__main__']
+requests = os.fdopen(os.dup(0), 'rb')
+channel = os.fdopen(os.dup(1), 'wb')
+stderr = os.dup(2)
+os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+os.dup2(stderr, 1)
+cwd = os.getcwd()
+while True:
+    header = requests.readline()
+    if not header:
+        break
+    mode, length = header.decode().split()
+    code = requests.read(int(length)).decode('utf8')
+    filename = '<stdin>' if mode == 'single' else '<string>'
+    pyplot = sys.modules.get('matplotlib.pyplot')
+    if pyplot is not None:
+        pyplot.close('all')
+    with tempfile.TemporaryFile() as output:
+        os.dup2(output.fileno(), 1)
+        os.dup2(output.fileno(), 2)
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+        sys.argv = ['-c']
+        module = types.ModuleType('__main__')
+        sys.modules['__main__'] = module
+        try:
+            exec(compile(code, filename, mode), module.__dict__)
+        except SystemExit as e:
+            if e.code is not None and not isinstance(e.code, int):
+                print(e.code, file=sys.stderr)
+        except BaseException:
+            etype, value, tb = sys.exc_info()
+            traceback.print_exception(etype, value, tb.tb_next)
+        sys.modules['__main__'] = main
+        sys.__stdout__.flush()
+        sys.__stderr__.flush()
+        os.dup2(stderr, 1)
+        os.dup2(stderr, 2)
+        os.chdir(cwd)
+        output.seek(0)
+        result = output.read()
+    channel.write(b'%d\n' % len(result) + result)
+    channel.flush()
+'''
+
 
 def select_executor(elem, doc):
     """Determines the executor for the code in `elem.text`.
@@ -43,23 +120,95 @@ def select_executor(elem, doc):
         doc  The document.
 
     Returns:
-        The command to execute code.
+        The command to execute code as a list of arguments.
     """
-    executor = EXECUTORS['default']
+    attrs = elem.attributes
+    classes = elem.classes
+    executor = EXECUTOR_ARGS['default']
+
+    if 'cmd' in attrs:
+        return shlex.split(attrs['cmd'])
+    elif 'runas' in attrs:
+        executor = EXECUTOR_ARGS[attrs['runas']]
+    elif classes[0] != 'exec':
+        executor = EXECUTOR_ARGS[classes[0]]
+
+    return list(executor)
+
+
+def execute_in_worker(code, executor, doc, mode='exec'):
+    """Executes code in the persistent worker for the executor.
 
-    if 'cmd' in elem.attributes.keys():
-        executor = elem.attributes['cmd']
-    elif 'runas' in elem.attributes.keys():
-        executor = EXECUTORS[elem.attributes['runas']]
-    elif elem.classes[0] != 'exec':
-        executor = EXECUTORS[elem.classes[0]]
+    The worker is started on first use and kept in `doc.workers` until
+    `finalize` shuts it down. It must only be used for code blocks in
+    document order, as the blocks share its interpreter state.
 
-    return executor
+    Args:
+        code     The code to execute.
+        executor The executor arguments, must be one of WORKER_EXECUTORS.
+        doc      The document.
+        mode     The compile mode, 'exec' for scripts or 'single' for
+                 interactive statements.
+
+    Returns:
+        The output of the code or None, if the worker could not be started or
+        the code could not be sent. If the worker dies while executing the
+        code, a message with its exit code is returned instead, as running
+        the code again might repeat its side effects.
+    """
+    worker = doc.workers.get(executor)
+    if worker is None:
+        try:
+            worker = subprocess.Popen(executor + (WORKER_BOOTSTRAP,),
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      env=EXECUTION_ENVIRONMENT)
+        except OSError:
+            return None
+        doc.workers[executor] = worker
+
+    request = code.encode('utf8')
+    try:
+        worker.stdin.write(b'%s %d\n' % (mode.encode(), len(request)) +
+                           request)
+        worker.stdin.flush()
+    except OSError:
+        del doc.workers[executor]
+        worker.kill()
+        worker.wait()
+        return None
+
+    try:
+        length = int(worker.stdout.readline())
+        output = worker.stdout.read(length).decode('utf8')
+        # Universal newlines, as in the text mode of a new process.
+        return output.replace('\r\n', '\n').replace('\r', '\n')
+    except (OSError, ValueError):
+        del doc.workers[executor]
+        worker.kill()
+        return 'Process exited with code {}.\n'.format(worker.wait())
+
+
+def stop_workers(doc):
+    """Shuts down all persistent workers of the document.
+
+    Args:
+        doc The document.
+    """
+    for worker in doc.workers.values():
+        worker.stdin.close()
+        worker.wait()
+        worker.stdout.close()
+    doc.workers.clear()
 
 
 def execute_code_block(elem, doc):
     """Executes a code block by passing it to the executor.
 
+    Code for WORKER_EXECUTORS without program arguments, working directory
+    and the class independent is run by a persistent worker in document
+    order, everything else by a new process.
+
     Args:
         elem The AST element.
         doc  The document.
@@ -67,29 +216,46 @@ def execute_code_block(elem, doc):
     Returns:
         The output of the command.
     """
-    command = select_executor(elem, doc).split(' ')
+    attrs = elem.attributes
+    classes = elem.classes
+    command = select_executor(elem, doc)
+    executor = tuple(command)
     code = elem.text
-    if 'plt' in elem.attributes or 'plt' in elem.classes:
+    if 'plt' in attrs or 'plt' in classes:
         code = save_plot(code, elem)
     command.append(code)
-    if 'args' in elem.attributes:
-        for arg in elem.attributes['args'].split():
+    if 'args' in attrs:
+        for arg in attrs['args'].split():
             command.append(arg)
 
-    cwd = elem.attributes['wd'] if 'wd' in elem.attributes else None
+    cwd = attrs['wd'] if 'wd' in attrs else None
 
-    return subprocess.run(command,
+    if executor in WORKER_EXECUTORS and 'args' not in attrs and \
+       cwd is None and 'independent' not in classes:
+        result = execute_in_worker(code, executor, doc)
+        if result is not None:
+            return result
+
+    # The output is read in chunks and joined once.
+    chunks = []
+    with subprocess.Popen(command,
                           encoding='utf8',
                           stdout=subprocess.PIPE,
                           stderr=subprocess.STDOUT,
-                          cwd=cwd).stdout
+                          cwd=cwd,
+                          env=EXECUTION_ENVIRONMENT) as process:
+        read = process.stdout.read
+        for chunk in iter(lambda: read(65536), ''):
+            chunks.append(chunk)
+    return ''.join(chunks)
 
 
 def execute_interactive_code(elem, doc):
     """Executes code blocks for a python shell.
 
     Parses the code in `elem.text` into blocks and
-    executes them.
+    executes them. A single block is executed by the python worker, multiple
+    blocks in an interactive session.
 
     Args:
         elem The AST element.
@@ -98,52 +264,254 @@ def execute_interactive_code(elem, doc):
     Return:
         The code with inline results.
     """
-    code_lines = [l[4:] for l in elem.text.split('\n')]
-
-    code_blocks = [[code_lines[0]]]
-    for line in code_lines[1:]:
-        if line.startswith(' ') or line == '':
-            code_blocks[-1].append(line)
-        else:
-            code_blocks.append([line])
+    # Editors often strip the space after a prompt on otherwise empty lines.
+    prompts = ('>>> ', '... ')
+    code_lines = [l[4:] if l.startswith(prompts) else
+                  ('' if l in ('>>>', '...') else l)
+                  for l in elem.text.split('\n')]
+
+    # Empty and indented lines continue a block, all other lines start one.
+    starts = [i for i, l in enumerate(code_lines)
+              if not i or l[:1] not in ('', ' ')]
+    code_blocks = [code_lines[begin:end] for begin, end in
+                   zip(starts, starts[1:] + [len(code_lines)])]
+
+    results = None
+    if len(code_blocks) == 1:
+        # A single statement does not need a REPL session, the python worker
+        # can run it in the same mode.
+        result = execute_in_worker('\n'.join(code_blocks[0]) + '\n',
+                                   EXECUTOR_ARGS['python3'], doc,
+                                   mode='single')
+        if result is not None:
+            results = [result.split('\n')]
+    if results is None:
+        results = execute_in_repl(code_blocks, elem)
+        if results is None:
+            return ''
 
     final_code = []
-    try:
-        child = replwrap.REPLWrapper("python", ">>> ", None)
-    except NameError:
-        pf.debug('Can not run interactive session. No output produced ' +
-                 '(Code was:\n{!s}\n)'
-                 .format(elem))
-        pf.debug('Please pip install pexpect.')
-        return ''
-    for code_block in code_blocks:
-        result = child.run_command('\n'.join(code_block) + '\n').rstrip('\r\n')
+    for code_block, result in zip(code_blocks, results):
         final_code += [('>>> ' if i == 0 else '... ') + l for i, l in
                        enumerate(code_block)]
+        result = '\n'.join(result).strip('\n')
         if result:
             final_code += [r for r in result.split('\n')
                            if r.strip() not in code_block]
     return '\n'.join(final_code)
 
 
-def read_file(filename):
-    """Reads a file which matches the pattern `filename`.
+def execute_in_repl(code_blocks, elem):
+    """Executes code blocks in an interactive python session.
+
+    Args:
+        code_blocks A list of code blocks, each a list of lines.
+        elem        The AST element.
+
+    Returns:
+        A list of output lines per code block or None, if no session could
+        be started.
+    """
+    try:
+        from pexpect import replwrap
+        child = replwrap.REPLWrapper("python", ">>> ", None)
+    except ImportError:
+        pf.debug('Can not run interactive session. No output produced ' +
+                 '(Code was:\n{!s}\n)'
+                 .format(elem))
+        pf.debug('Please pip install pexpect.')
+        return None
+    # All blocks are written to the session at once, each followed by a print
+    # of the sentinel, and the output is read up to each sentinel. The print
+    # statement is split so that its echo does not match.
+    sentinel = '__PSE_SEP_{}__'.format(id(elem))
+    marker = 'print({!r} + {!r})'.format(sentinel[:6], sentinel[6:])
+    child.child.send(''.join(line + '\n' for code_block in code_blocks
+                             for line in code_block + ['', marker]))
+    results = []
+    for i, code_block in enumerate(code_blocks):
+        child.child.expect_exact(sentinel + '\r\n')
+        # The shell prints a prompt for every line it reads, the first prompt
+        # was already consumed when the session started.
+        prompts = len(code_block) + 2 - (i == 0)
+        output = strip_prompts(child.child.before, prompts)
+        results.append([r.rstrip('\r') for r in output.split('\n')
+                        if r.strip() != marker])
+    return results
+
+
+def strip_prompts(output, count):
+    """Removes the prompts around the output of one interactive statement.
+
+    The shell prints a prompt before reading each line. A statement produces
+    its output in one piece, so the prompts are all in front of or behind it.
+    Prompts behind the output are removed first, the remaining ones in front.
+
+    Args:
+        output The output of the shell.
+        count  The number of prompts printed.
+
+    Returns:
+        The output without the prompts.
+    """
+    prompts = ('>>> ', '... ')
+    while count and output.endswith(prompts):
+        output = output[:-4]
+        count -= 1
+    while count and output.startswith(prompts):
+        output = output[4:]
+        count -= 1
+    return output
+
+
+def build_file_index(root='.'):
+    """Maps all file names below root to their paths.
+
+    Hidden files and directories are skipped, just as `glob` does.
+
+    Args:
+        root The directory to index.
+
+    Returns:
+        A dictionary from file names to lists of paths.
+    """
+    index = {}
+    for path, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for name in sorted(filenames):
+            if not name.startswith('.'):
+                index.setdefault(name, []).append(
+                    os.path.normpath(os.path.join(path, name)))
+    return index
+
+
+def find_files(filename, doc):
+    """Finds all files which match the pattern `filename`.
+
+    Plain file names are looked up in `doc.file_index`, which is built on
+    first use. Patterns and names not found in the index are globbed, but
+    only until a second match shows that the pattern is ambiguous.
 
     Args:
         filename The filename pattern
+        doc      The document.
+
+    Returns:
+        A list of matching paths.
+    """
+    if not glob.has_magic(filename):
+        if doc.file_index is None:
+            doc.file_index = build_file_index()
+        suffix = os.sep + os.path.normpath(filename)
+        hits = [path for path in
+                doc.file_index.get(os.path.basename(filename), [])
+                if (os.sep + path).endswith(suffix)]
+        if hits:
+            return hits
+    return list(itertools.islice(
+        glob.iglob('**/{}'.format(filename), recursive=True), 2))
+
+
+def read_path(path, doc):
+    """Reads the file at `path`. The contents are cached in `doc.file_cache`,
+    as the same file is often included multiple times. The modification time
+    is part of the key, so files written by code blocks are read again.
+
+    Args:
+        path The path to the file.
+        doc  The document.
+
+    Returns:
+        The file content.
+    """
+    path = os.path.realpath(path)
+    key = (path, os.stat(path).st_mtime_ns)
+    if key not in doc.file_cache:
+        with open(path, 'r') as f:
+            doc.file_cache[key] = f.read()
+    return doc.file_cache[key]
+
+
+def read_lines(path, line_spec):
+    """Reads only the lines of the file at `path` matching the line_spec.
+
+    The file is read line by line and only up to the last requested line.
+
+    Args:
+        path      The path to the file.
+        line_spec The line specification, see `filter_lines`.
+
+    Returns:
+        The specified lines.
+    """
+    keep_lines = []
+    with open(path, 'r') as f:
+        # Lines are split like str.splitlines in `filter_lines`.
+        lines = (line for physical_line in f
+                 for line in physical_line.splitlines())
+        position = 0
+        for begin, end in parse_line_spec(line_spec):
+            keep_lines.extend(itertools.islice(lines, begin - 1 - position,
+                                               end - position))
+            position = end
+    return '\n'.join(keep_lines)
+
+
+def read_file(filename, doc, line_spec=None):
+    """Reads a file which matches the pattern `filename`.
+
+    Args:
+        filename  The filename pattern
+        doc       The document.
+        line_spec If given, only lines matching this line specification are
+                  read (see `filter_lines`).
 
     Returns:
         The file content or the empty string, if the file is not found.
     """
-    hits = glob.glob('**/{}'.format(filename), recursive=True)
+    hits = find_files(filename, doc)
     if not len(hits):
         pf.debug('No file "{}" found.'.format(filename))
         return ''
     elif len(hits) > 1:
         pf.debug('File pattern "{}" ambiguous. Using first.'.format(filename))
 
-    with open(hits[0], 'r') as f:
-        return f.read()
+    if line_spec is not None:
+        return read_lines(hits[0], line_spec)
+    return read_path(hits[0], doc)
+
+
+def parse_line_spec(line_spec):
+    """Parses a line specification into sorted, disjoint line intervals.
+
+    Empty elements, e.g. from a trailing comma, are skipped.
+
+    Args:
+        line_spec The line specification, see `filter_lines`.
+
+    Returns:
+        A list of inclusive (begin, end) tuples. Open ends are sys.maxsize.
+    """
+    intervals = []
+    for line_denom in line_spec.split(','):
+        line_denom = line_denom.strip()
+        if not line_denom:
+            continue
+        begin, dash, end = line_denom.partition('-')
+        if not dash:
+            end = begin
+        begin = max(int(begin), 1) if begin else 1
+        end = int(end) if end else sys.maxsize
+        if begin <= end:
+            intervals.append((begin, end))
+
+    merged = []
+    for begin, end in sorted(intervals):
+        if merged and begin <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((begin, end))
+    return merged
 
 
 def filter_lines(code, line_spec):
@@ -163,29 +531,13 @@ def filter_lines(code, line_spec):
     """
     code_lines = code.splitlines()
 
-    line_specs = [line_denom.strip() for line_denom in line_spec.split(',')]
-
-    single_lines = set(map(int, filter(lambda line: '-' not in line, line_specs)))
-    line_ranges = set(filter(lambda line: '-' in line, line_specs))
-
-    for line_range in line_ranges:
-        begin, end = line_range.split('-')
-        if not begin:
-            begin = 1
-        if not end:
-            end = len(code_lines)
-        single_lines.update(range(int(begin), int(end) + 1))
-
     keep_lines = []
-    for line_number, line in enumerate(code_lines, 1):
-        if line_number in single_lines:
-            keep_lines.append(line)
+    for begin, end in parse_line_spec(line_spec):
+        keep_lines.extend(code_lines[begin - 1:end])
 
     return '\n'.join(keep_lines)
 
 
-
-
 def remove_import_statements(code):
     """Removes lines with import statements from the code.
 
@@ -195,18 +547,7 @@ def remove_import_statements(code):
     Returns:
         The code without import statements.
     """
-    new_code = []
-    for line in code.splitlines():
-        if not line.lstrip().startswith('import ') and \
-           not line.lstrip().startswith('from '):
-            new_code.append(line)
-
-    while new_code and new_code[0] == '':
-        new_code.pop(0)
-    while new_code and new_code[-1] == '':
-        new_code.pop()
-
-    return '\n'.join(new_code)
+    return IMPORT_STATEMENT.sub('', code).strip('\n')
 
 
 def save_plot(code, elem):
@@ -217,6 +558,9 @@ def save_plot(code, elem):
     are set accordingly. If none are given, a height of 4cm and a width of 6cm
     is used as default.
 
+    The plots are drawn with the Agg backend, which EXECUTION_ENVIRONMENT
+    selects through the MPLBACKEND environment variable.
+
     Args:
         code: The matplotlib code.
         elem: The element.
@@ -237,12 +581,9 @@ def save_plot(code, elem):
         except KeyError:
             figurewidth = '6cm'
 
-    return f"""import matplotlib
-matplotlib.use('TkAgg')
-{code}
+    return f"""{code}
 from matplotlib2tikz import get_tikz_code
-tikz = get_tikz_code(figureheight='{figureheight}', figurewidth='{figurewidth}')  # noqa
-print(tikz)"""
+print(get_tikz_code(figureheight='{figureheight}', figurewidth='{figurewidth}'))  # noqa"""
 
 
 def trimpath(attributes):
@@ -258,17 +599,34 @@ def trimpath(attributes):
     Returns:
         The trimmed path.
     """
-    if 'pathdepth' in attributes:
-        if attributes['pathdepth'] != 'full':
-            pathelements = []
-            remainder = attributes['file']
-            limit = int(attributes['pathdepth'])
-            while len(pathelements) < limit and remainder:
-                remainder, pe = os.path.split(remainder)
-                pathelements.insert(0, pe)
-            return os.path.join(*pathelements)
-        return attributes['file']
-    return os.path.basename(attributes['file'])
+    path = attributes['file']
+    depth = attributes.get('pathdepth')
+    if depth is None:
+        return os.path.basename(path)
+    if depth == 'full':
+        return path
+    parts = os.path.normpath(path).split(os.sep)
+    return os.sep.join(parts[-int(depth):])
+
+
+@functools.lru_cache(maxsize=256)
+def to_latex(*texts):
+    """Converts markdown texts to LaTeX.
+
+    Each conversion runs pandoc, so all texts are converted at once, separated
+    by LATEX_SEPARATOR paragraphs, and results are cached for repeated
+    captions.
+
+    Args:
+        texts: The markdown texts.
+
+    Returns:
+        A tuple with the LaTeX code for each text.
+    """
+    separator = '\n\n{}\n\n'.format(LATEX_SEPARATOR)
+    latex = pf.convert_text(separator.join(texts), output_format='latex')
+    return tuple(part.strip() for part in
+                 re.split(r'\s*{}\s*'.format(LATEX_SEPARATOR), latex))
 
 
 def make_codelisting(inner_elements, caption, label, *,
@@ -308,11 +666,57 @@ def make_codelisting(inner_elements, caption, label, *,
     return [begin] + inner_elements + [caption_elem, end]
 
 
+def promote_boolean_attributes(elem):
+    """Allow boolean values with value "True" to be specified as attributes,
+    but used as classes.
+
+    Args:
+        elem: The element.
+    """
+    for a, v in elem.attributes.items():
+        if v.lower() == 'true' and a not in elem.classes:
+            elem.classes.append(a)
+
+
+def submit_code_block(elem, doc):
+    """Submits independent code blocks for execution.
+
+    Code blocks usually run in document order, as later blocks may depend on
+    earlier ones. Code blocks with the class independent do not, so they are
+    executed in `doc.pool` while the document is processed. `action` collects
+    the results from `doc.executions`. Code blocks with file= are read and
+    executed in document order, as the file might be written by an earlier
+    code block.
+
+    Args:
+        elem: The element to process.
+        doc:  The document.
+    """
+    if isinstance(elem, pf.CodeBlock):
+        promote_boolean_attributes(elem)
+        classes = elem.classes
+        if 'exec' not in classes or 'independent' not in classes or \
+           'interactive' in classes or 'file' in elem.attributes:
+            return
+
+        if elem.text[:4] != '>>> ':
+            doc.executions[id(elem)] = doc.pool.submit(execute_code_block,
+                                                       elem, doc)
+
+
 def prepare(doc):
-    """Sets the caption_found and plot_found variables to False."""
+    """Sets the caption_found and plot_found variables to False, prepares
+    the dictionary of persistent workers, the file index and the file cache
+    and submits all independent code blocks for execution."""
     doc.caption_found = False
     doc.plot_found = False
     doc.listings_counter = 0
+    doc.workers = {}
+    doc.file_index = None
+    doc.file_cache = {}
+    doc.executions = {}
+    doc.pool = concurrent.futures.ThreadPoolExecutor(os.cpu_count())
+    doc.walk(submit_code_block, doc)
 
 
 def maybe_center_plot(result):
@@ -327,7 +731,9 @@ def maybe_center_plot(result):
         The input result if no tikzpicture was found, otherwise a centered
         version.
     """
-    begin = re.search('(% .* matplotlib2tikz v.*)', result)
+    if 'matplotlib2tikz v' not in result:
+        return result
+    begin = TIKZ_COMMENT.search(result)
     if begin:
         result = ('\\begin{center}\n' + result[begin.end():] +
                   '\n\\end{center}')
@@ -349,29 +755,44 @@ def action(elem, doc):  # noqa
     """
     if isinstance(elem, pf.CodeBlock):
         doc.listings_counter += 1
-        elems = [elem] if 'hide' not in elem.classes else []
-
-        if 'file' in elem.attributes:
-            elem.text = read_file(elem.attributes['file'])
-            filename = trimpath(elem.attributes)
+        execution = doc.executions.pop(id(elem), None)
+        promote_boolean_attributes(elem)
+
+        attrs = elem.attributes
+        classes = set(elem.classes)
+        has_file = 'file' in attrs
+        has_lines = 'lines' in attrs
+        has_exec = 'exec' in classes
+        has_plot = 'plt' in attrs or 'plt' in classes
+        has_caption_attr = 'caption' in attrs
+        has_caption_class = 'caption' in classes
+        above = 'capbelow' not in classes
+
+        code = [elem] if 'hide' not in classes else []
+        output = []
+
+        # Files which are not executed are only read as far as needed.
+        read_lines_only = has_file and has_lines and not has_exec
+
+        if has_file:
+            elem.text = read_file(attrs['file'], doc, attrs['lines']
+                                  if read_lines_only else None)
+            filename = trimpath(attrs)
             prefix = pf.Emph(pf.Str('File:'))
 
-        # Allow boolean values with value "True" to be specified as attributes,
-        # but used as classes.
-        for a, v in elem.attributes.items():
-            if v.lower() == 'true':
-                elem.classes.append(a)
-
-        if 'exec' in elem.classes:
-            if 'interactive' in elem.classes or elem.text[:4] == '>>> ':
+        if has_exec:
+            if 'interactive' in classes or elem.text[:4] == '>>> ':
                 elem.text = execute_interactive_code(elem, doc)
             else:
-                result = execute_code_block(elem, doc)
+                if execution is not None:
+                    result = execution.result()
+                else:
+                    result = execute_code_block(elem, doc)
 
-                if 'hideimports' in elem.classes:
+                if 'hideimports' in classes:
                     elem.text = remove_import_statements(elem.text)
 
-                if 'plt' in elem.attributes or 'plt' in elem.classes:
+                if has_plot:
                     doc.plot_found = True
                     result = maybe_center_plot(result)
                     block = pf.RawBlock(result, format='latex')
@@ -379,49 +800,49 @@ def action(elem, doc):  # noqa
                     block = pf.CodeBlock(result, classes=['changelog'])
 
                 if result:
-                    output_label = 'Output:'
-                    if 'output_label' in elem.attributes:
-                        output_label = elem.attributes['output_label']
+                    output_label = attrs.get('output_label', 'Output:')
                     if output_label != '':
-                        elems += [pf.Para(pf.Emph(pf.Str(output_label))), block]
+                        output = [pf.Para(pf.Emph(pf.Str(output_label))),
+                                  block]
                     else:
-                        elems += [block]
+                        output = [block]
 
-        if 'lines' in elem.attributes:
-            elem.text = filter_lines(elem.text, elem.attributes['lines'])
+        if has_lines and not read_lines_only:
+            elem.text = filter_lines(elem.text, attrs['lines'])
 
-        label = elem.attributes.get('label', f'cl:{doc.listings_counter}')
+        elems = code + output
+        label = attrs.get('label', f'cl:{doc.listings_counter}')
 
-        if 'caption' in elem.attributes.keys():
+        if has_caption_attr:
             doc.caption_found = True
-            cap = pf.convert_text(elem.attributes['caption'], output_format='latex')  # noqa
-            if 'shortcaption' in elem.attributes.keys():
-                shortcap = pf.convert_text(elem.attributes['shortcaption'], output_format='latex')  # noqa
-            else:
+            cap, shortcap, filecap = to_latex(
+                attrs['caption'], attrs.get('shortcaption', ''),
+                f'&nbsp;(`{filename}`)' if has_file else '')
+            if 'shortcaption' not in attrs:
                 shortcap = cap
-            if 'file' in elem.attributes.keys():
-                cap += pf.convert_text(f'&nbsp;(`{filename}`)', output_format='latex')  # noqa
+            cap += filecap
 
             elems = make_codelisting(elems, cap, label, shortcaption=shortcap,
-                                     above='capbelow' not in elem.classes)
-        elif 'caption' in elem.classes:
+                                     above=above)
+        elif has_caption_class:
             doc.caption_found = True
             cap = ''
-            if 'file' in elem.attributes.keys():
-                cap = pf.convert_text(f'`{filename}`', output_format='latex')
-            elems = make_codelisting(elems, cap, label,
-                                     above='capbelow' not in elem.classes)
-        else:
-            if 'file' in elem.attributes.keys():
-                elems.insert(0, pf.Para(prefix, pf.Space,
-                                        pf.Code(filename)))
+            if has_file:
+                cap, = to_latex(f'`{filename}`')
+            elems = make_codelisting(elems, cap, label, above=above)
+        elif has_file:
+            elems = [pf.Para(prefix, pf.Space, pf.Code(filename))] + elems
 
         return elems
 
 
 def finalize(doc):
-    """Adds the pgfplots and caption packages to the header-includes if needed.
+    """Adds the pgfplots and caption packages to the header-includes if needed
+    and shuts down the execution pool and the persistent workers.
     """
+    doc.pool.shutdown()
+    stop_workers(doc)
+
     if doc.plot_found:
         pgfplots_inline = pf.MetaInlines(pf.RawInline(
             r'''%
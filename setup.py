@@ -4,13 +4,14 @@ from setuptools import setup
 
 import re
 
-from pandoc_source_exec import __version__
-
 REPOSITORY = 'https://github.com/shoeffner/pandoc-source-exec'
 
 README = ''
 with open('README.rst', 'r') as f:
     README = f.read()
+with open('pandoc_source_exec.py', 'r') as f:
+    __version__ = re.search(r"^__version__ = '(.+)'$", f.read(), re.M).group(1)
+
 README = re.sub(r' _(.+): ([^(http)].+)', r' _\1: {}/blob/master/\2'
                 .format(REPOSITORY), README)
 